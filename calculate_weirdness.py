@@ -4,118 +4,214 @@ Language Weirdness Calculator
 Analyzes WALS dataset to compute weirdness scores based on feature rarity.
 """
 
+import argparse
+import os
 import pandas as pd
 import numpy as np
-import json
-from collections import Counter
+import orjson
+from numba import njit, prange
+
+# Metadata strings are stored in Arrow with native missing-value masks
+METADATA_DTYPES = {c: 'string[pyarrow]' for c in ['Name', 'wals_code', 'family', 'genus', 'macroarea']}
+
 
 def calculate_feature_rarity_scores(df, feature_cols):
     """
     For each feature, calculate rarity scores for each possible value.
     Rarity = 1 - (frequency of value / total non-missing values)
-    Returns a dictionary mapping feature -> value -> rarity_score
+    Returns a dictionary mapping feature -> value -> rarity_score, the feature
+    stats, and a dictionary mapping feature -> array of rarities by category code
     """
     rarity_scores = {}
     feature_stats = {}
+    rarity_arrays = {}
+    
+    # Count every (feature, value) pair in one pass, most common first
+    long = df[feature_cols].melt(var_name='feature', value_name='value').dropna()
+    counts = long.groupby(['feature', 'value'], sort=False, observed=True).size()
+    counts = counts.sort_values(ascending=False, kind='stable')
+    by_feature = counts.groupby(level='feature', sort=False)
+    totals = by_feature.transform('sum')
+    
+    # Calculate rarity score for each value (0 = most common, 1 = rarest)
+    rarity = 1.0 - counts / totals
+    rarity_by_feature = {f: grp.droplevel('feature') for f, grp in rarity.groupby(level='feature', sort=False)}
+    
+    # Per-feature stats straight from the grouped counts
+    total_responses = by_feature.sum().to_dict()
+    unique_values = by_feature.size().to_dict()
+    top = by_feature.head(1)
+    most_common = dict(zip(top.index.get_level_values('feature'),
+                           zip(top.index.get_level_values('value'), top.tolist())))
     
     for feature in feature_cols:
-        # Get non-missing values
-        values = df[feature].dropna()
-        
-        if len(values) == 0:
+        if feature not in rarity_by_feature:
             continue
-            
-        # Count frequency of each value
-        value_counts = Counter(values)
-        total = len(values)
         
-        # Calculate rarity score for each value (0 = most common, 1 = rarest)
-        feature_rarity = {}
-        for value, count in value_counts.items():
-            frequency = count / total
-            rarity = 1 - frequency
-            feature_rarity[value] = rarity
+        rarity_scores[feature] = rarity_by_feature[feature].to_dict()
         
-        rarity_scores[feature] = feature_rarity
+        rarity_arrays[feature] = (
+            rarity_by_feature[feature].reindex(df[feature].cat.categories).to_numpy(np.float32))
         
         # Store stats for analysis
         feature_stats[feature] = {
-            'total_responses': total,
-            'unique_values': len(value_counts),
-            'most_common': value_counts.most_common(1)[0] if value_counts else None
+            'total_responses': total_responses[feature],
+            'unique_values': unique_values[feature],
+            'most_common': most_common[feature]
         }
     
-    return rarity_scores, feature_stats
+    return rarity_scores, feature_stats, rarity_arrays
 
 
-def calculate_weirdness_scores(df, feature_cols, rarity_scores):
+@njit(parallel=True, cache=True)
+def _weirdness_kernel(codes, rarities, k):
     """
-    Calculate weirdness score for each language.
-    Weirdness = average rarity across all features that language has data for.
+    Average rarity and top-k rarest features for each row of category codes.
+    Missing values have code -1, the pandas convention for Categorical NaN.
     """
-    weirdness_data = []
+    n, num_cols = codes.shape
+    scores = np.empty(n, dtype=np.float32)
+    counts = np.zeros(n, dtype=np.int64)
+    top_idx = np.full((n, k), -1, dtype=np.int64)
+    top_vals = np.full((n, k), -np.inf, dtype=np.float32)
     
-    for idx, row in df.iterrows():
-        language_name = row['Name']
-        
-        # Collect rarity scores for all features this language has
-        language_rarities = []
-        feature_contributions = []
-        
-        for feature in feature_cols:
-            value = row[feature]
-            
-            # Skip if missing or if we don't have rarity scores
-            if pd.isna(value) or feature not in rarity_scores:
+    for i in prange(n):
+        s = 0.0
+        c = 0
+        for j in range(num_cols):
+            code = codes[i, j]
+            if code < 0:
                 continue
+            r = rarities[j, code]
+            s += r
+            c += 1
             
-            # Get rarity score for this value
-            if value in rarity_scores[feature]:
-                rarity = rarity_scores[feature][value]
-                language_rarities.append(rarity)
-                feature_contributions.append({
-                    'feature': feature,
-                    'value': value,
-                    'rarity': rarity
-                })
-        
-        # Calculate average weirdness
-        if language_rarities:
-            weirdness_score = np.mean(language_rarities)
-            num_features = len(language_rarities)
-        else:
-            weirdness_score = None
-            num_features = 0
-        
-        # Sort features by contribution to weirdness
-        feature_contributions.sort(key=lambda x: x['rarity'], reverse=True)
+            # Insert into this row's top-k, kept sorted with earlier features first on ties
+            if r > top_vals[i, k - 1]:
+                pos = k - 1
+                while pos > 0 and top_vals[i, pos - 1] < r:
+                    top_vals[i, pos] = top_vals[i, pos - 1]
+                    top_idx[i, pos] = top_idx[i, pos - 1]
+                    pos -= 1
+                top_vals[i, pos] = r
+                top_idx[i, pos] = j
         
-        weirdness_data.append({
-            'name': language_name,
-            'wals_code': row['wals_code'],
-            'latitude': row['latitude'],
-            'longitude': row['longitude'],
-            'family': row['family'],
-            'genus': row['genus'],
-            'macroarea': row['macroarea'],
-            'weirdness_score': weirdness_score,
-            'num_features': num_features,
-            'top_weird_features': feature_contributions[:5]  # Top 5 weirdest features
-        })
-    
-    return pd.DataFrame(weirdness_data)
-
-
-def main():
+        scores[i] = s / c if c else np.nan
+        counts[i] = c
+    
+    return scores, counts, top_idx, top_vals
+
+
+def calculate_weirdness_scores(df, feature_cols, rarity_scores, rarity_arrays):
+    """
+    Calculate weirdness score for each language.
+    Weirdness = average rarity across all features that language has data for.
+    """
+    # Category codes for every language and feature (-1 where missing)
+    codes = np.stack([df[f].cat.codes.to_numpy(np.int16) for f in feature_cols], axis=1)
+    
+    # Rarity by category code, padded with NaN to the widest feature.
+    # float32 is plenty for rarities in [0, 1] and halves the bytes scanned.
+    max_cats = max(len(df[f].cat.categories) for f in feature_cols)
+    rarities = np.full((len(feature_cols), max_cats), np.nan, dtype=np.float32)
+    for j, feature in enumerate(feature_cols):
+        if feature in rarity_arrays:
+            rarities[j, :rarity_arrays[feature].size] = rarity_arrays[feature]
+    
+    # Average weirdness (NaN for languages with no features) and the top 5
+    # weirdest features per language in a single pass
+    k = min(5, len(feature_cols))
+    weirdness_score, num_features, top_idx, top_vals = _weirdness_kernel(codes, rarities, k)
+    
+    # Only the retained features are turned back into values and dicts
+    top_codes = np.take_along_axis(codes, top_idx, axis=1)
+    categories = [df[f].cat.categories for f in feature_cols]
+    
+    # Languages with fewer than 5 features have -inf padding at the end.
+    # Reported rarities come from the full-precision rarity_scores.
+    top_weird_features = []
+    for row_idx, row_codes, row_vals in zip(top_idx.tolist(), top_codes.tolist(), top_vals.tolist()):
+        features = []
+        for j, code, rarity in zip(row_idx, row_codes, row_vals):
+            if rarity == -np.inf:
+                break
+            value = categories[j][code]
+            features.append({
+                'feature': feature_cols[j],
+                'value': value,
+                'rarity': rarity_scores[feature_cols[j]][value]
+            })
+        top_weird_features.append(features)
+    
+    return pd.DataFrame({
+        'name': df['Name'].array,
+        'wals_code': df['wals_code'].array,
+        'latitude': df['latitude'].array,
+        'longitude': df['longitude'].array,
+        'family': df['family'].array,
+        'genus': df['genus'].array,
+        'macroarea': df['macroarea'].array,
+        'weirdness_score': weirdness_score,
+        'num_features': num_features,
+        'top_weird_features': top_weird_features
+    })
+
+
+def top_k_positions(scores, k):
+    """
+    Positions of the k largest scores, largest first. Ties are taken and
+    ordered by position, matching nlargest(keep='first').
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+    above = np.flatnonzero(scores > kth)
+    tied = np.flatnonzero(scores == kth)[:k - above.size]
+    top = np.concatenate([above, tied])
+    return top[np.lexsort((top, -scores[top]))]
+
+
+def format_missing(value):
+    """
+    Render missing metadata as 'nan', as the report did before string dtypes.
+    """
+    return 'nan' if pd.isna(value) else value
+
+
+def load_dataset(csv_path='language.csv', cache_path='language.feather'):
+    """
+    Load the WALS dataset with feature columns as categoricals.
+    The parsed table is cached as Feather next to the CSV and reused until
+    the CSV changes or the cached dtypes no longer match what is parsed.
+    """
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        df = pd.read_feather(cache_path)
+        # A cache written with older parse settings is rebuilt, not trusted
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in df.dtypes.iloc[10:]):
+            # Older pandas reads Arrow strings back as python-backed 'string'
+            return df.astype(METADATA_DTYPES)
+    
+    # Feature values are a handful of repeated codes per column, so parse
+    # them straight into categoricals (feature columns follow 'countrycodes')
+    header = pd.read_csv(csv_path, nrows=0).columns.tolist()
+    feature_cols = header[10:]
+    df = pd.read_csv(csv_path, dtype={**METADATA_DTYPES, **{c: 'category' for c in feature_cols}})
+    
+    df.to_feather(cache_path)
+    return df
+
+
+def main(write_csv=False):
     print("Loading WALS dataset...")
-    df = pd.read_csv('language.csv')
+    df = load_dataset()
     
     # Get feature columns (everything after 'countrycodes')
     feature_cols = df.columns[10:].tolist()
     print(f"Found {len(feature_cols)} feature columns")
     
     print("\nCalculating rarity scores for each feature value...")
-    rarity_scores, feature_stats = calculate_feature_rarity_scores(df, feature_cols)
+    rarity_scores, feature_stats, rarity_arrays = calculate_feature_rarity_scores(df, feature_cols)
     
     print(f"Processed {len(rarity_scores)} features with data")
     
@@ -127,7 +223,7 @@ def main():
             print(f"  {value}: rarity = {rarity:.3f}")
     
     print("\nCalculating weirdness scores for each language...")
-    weirdness_df = calculate_weirdness_scores(df, feature_cols, rarity_scores)
+    weirdness_df = calculate_weirdness_scores(df, feature_cols, rarity_scores, rarity_arrays)
     
     # Remove languages with no weirdness score
     weirdness_df = weirdness_df[weirdness_df['weirdness_score'].notna()]
@@ -143,22 +239,23 @@ def main():
     print("\n" + "="*70)
     print("TOP 10 WEIRDEST LANGUAGES (with at least 10 features):")
     print("="*70)
-    top_10 = weirdness_df_robust.nlargest(10, 'weirdness_score')
-    for idx, row in top_10.iterrows():
-        print(f"\n{row['name']} (Family: {row['family']})")
-        print(f"  Weirdness Score: {row['weirdness_score']:.4f}")
-        print(f"  Based on {row['num_features']} features")
+    scores = weirdness_df_robust['weirdness_score'].to_numpy()
+    top_10 = weirdness_df_robust.iloc[top_k_positions(scores, 10)]
+    for row in top_10.itertuples(index=False):
+        print(f"\n{row.name} (Family: {format_missing(row.family)})")
+        print(f"  Weirdness Score: {row.weirdness_score:.4f}")
+        print(f"  Based on {row.num_features} features")
         print(f"  Top weird features:")
-        for feat in row['top_weird_features'][:3]:
+        for feat in row.top_weird_features[:3]:
             print(f"    - {feat['feature']}: {feat['value']} (rarity: {feat['rarity']:.3f})")
     
     # Show bottom 10 (most "normal" languages)
     print("\n" + "="*70)
     print("TOP 10 MOST 'NORMAL' LANGUAGES (with at least 10 features):")
     print("="*70)
-    bottom_10 = weirdness_df_robust.nsmallest(10, 'weirdness_score')
-    for idx, row in bottom_10.iterrows():
-        print(f"{row['name']}: {row['weirdness_score']:.4f} ({row['num_features']} features, Family: {row['family']})")
+    bottom_10 = weirdness_df_robust.iloc[top_k_positions(-scores, 10)]
+    for row in bottom_10.itertuples(index=False):
+        print(f"{row.name}: {row.weirdness_score:.4f} ({row.num_features} features, Family: {format_missing(row.family)})")
     
     # Statistics
     print("\n" + "="*70)
@@ -182,45 +279,46 @@ def main():
     # Save results
     print("\nSaving results...")
     
-    # Save full dataset as CSV
-    weirdness_df.to_csv('language_weirdness_scores.csv', index=False)
-    print("  ✓ Saved language_weirdness_scores.csv")
+    # Save full dataset as Parquet (top_weird_features is stored as a list of structs)
+    weirdness_df.to_parquet('language_weirdness_scores.parquet', engine='pyarrow',
+                            compression='zstd', index=False)
+    print("  ✓ Saved language_weirdness_scores.parquet")
+    
+    if write_csv:
+        weirdness_df.to_csv('language_weirdness_scores.csv', index=False)
+        print("  ✓ Saved language_weirdness_scores.csv")
     
     # Save JSON for web map (simplified version)
-    map_data = []
-    for idx, row in weirdness_df.iterrows():
-        map_data.append({
-            'name': row['name'],
-            'lat': float(row['latitude']) if pd.notna(row['latitude']) else None,
-            'lon': float(row['longitude']) if pd.notna(row['longitude']) else None,
-            'family': row['family'] if pd.notna(row['family']) else 'Unknown',
-            'genus': row['genus'] if pd.notna(row['genus']) else 'Unknown',
-            'weirdness': float(row['weirdness_score']),
-            'numFeatures': int(row['num_features']),
-            'topFeatures': [
-                {
-                    'feature': f['feature'],
-                    'value': f['value'],
-                    'rarity': float(f['rarity'])
-                }
-                for f in row['top_weird_features'][:3]
-            ]
-        })
+    export = weirdness_df[['name', 'latitude', 'longitude', 'family', 'genus',
+                           'weirdness_score', 'num_features', 'top_weird_features']].copy()
+    export[['family', 'genus']] = export[['family', 'genus']].fillna('Unknown')
+    export['top_weird_features'] = [feats[:3] for feats in export['top_weird_features']]
     
     # Filter out languages with invalid coordinates
-    map_data = [lang for lang in map_data if lang['lat'] is not None and lang['lon'] is not None]
+    export = export.dropna(subset=['latitude', 'longitude'])
+    export = export.rename(columns={
+        'latitude': 'lat',
+        'longitude': 'lon',
+        'weirdness_score': 'weirdness',
+        'num_features': 'numFeatures',
+        'top_weird_features': 'topFeatures'
+    })
+    map_data = export.to_dict(orient='records')
     
-    with open('language_data.json', 'w') as f:
-        json.dump(map_data, f, indent=2)
+    with open('language_data.json', 'wb') as f:
+        f.write(orjson.dumps(map_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     print("  ✓ Saved language_data.json")
     
     # Save feature statistics
-    with open('feature_stats.json', 'w') as f:
-        json.dump(feature_stats, f, indent=2)
+    with open('feature_stats.json', 'wb') as f:
+        f.write(orjson.dumps(feature_stats, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     print("  ✓ Saved feature_stats.json")
     
     print("\nDone! Ready to create the interactive map.")
     
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--csv', action='store_true',
+                        help='also write language_weirdness_scores.csv for older tooling')
+    main(write_csv=parser.parse_args().csv)